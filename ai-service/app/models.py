@@ -1,14 +1,18 @@
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union
 
 class DBConnection(BaseModel):
     type: str
     config: Dict[str, Any]
 
+class HistoryMessage(BaseModel):
+    role: str
+    content: str
+
 class QueryRequest(BaseModel):
     question: str
     db_connection: DBConnection
-    history: List[str] = []
+    history: List[Union[HistoryMessage, str]] = []
 
 class SchemaRequest(BaseModel):
     db_connection: DBConnection
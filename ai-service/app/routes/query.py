@@ -1,9 +1,15 @@
 from fastapi import APIRouter
-from ..models import QueryRequest
-from ..services.sql_generation import generate_sql_response
+from ..models import QueryRequest, SchemaRequest
+from ..services.sql_generation import generate_sql_response, invalidate_query_caches
+from ..services.schema_inspection import invalidate_schema
 
 router = APIRouter()
 
 @router.post("/query")
-async def process_query(request: QueryRequest):
-    return await generate_sql_response(request)
+async def process_query(request: QueryRequest, nocache: bool = False, stream: bool = False):
+    return await generate_sql_response(request, use_cache=not nocache, stream=stream)
+
+@router.post("/invalidate_cache")
+async def invalidate_cache(request: SchemaRequest):
+    invalidate_schema(request.db_connection)
+    return {"invalidated": invalidate_query_caches(request.db_connection)}
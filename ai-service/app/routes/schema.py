@@ -1,13 +1,17 @@
-from fastapi import APIRouter, HTTPException
+import asyncio
+from fastapi import APIRouter, BackgroundTasks, HTTPException
 from ..models import SchemaRequest
 from ..services.schema_inspection import get_schema_info_service, suggest_questions_service
+from ..services.sql_generation import warm_prompt_cache
 
 router = APIRouter()
 
 @router.post("/schema")
-async def get_schema(request: SchemaRequest):
+async def get_schema(request: SchemaRequest, background_tasks: BackgroundTasks):
     try:
-        return get_schema_info_service(request.db_connection)
+        schema = await asyncio.to_thread(get_schema_info_service, request.db_connection)
+        background_tasks.add_task(warm_prompt_cache, request.db_connection)
+        return schema
     except Exception as e:
         print(f"Error fetching schema: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -15,7 +19,7 @@ async def get_schema(request: SchemaRequest):
 @router.post("/suggest_questions")
 async def suggest_questions(request: SchemaRequest):
     try:
-        return suggest_questions_service(request.db_connection)
+        return await asyncio.to_thread(suggest_questions_service, request.db_connection)
     except Exception as e:
         print(f"Error suggesting questions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
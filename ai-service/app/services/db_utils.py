@@ -1,60 +1,335 @@
+import io
 import os
+import json
+import fcntl
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import weakref
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
+from langchain_community.utilities import SQLDatabase
 from urllib.parse import quote_plus
+from collections import OrderedDict
 from ..models import DBConnection
 
-def get_engine(db_connection: DBConnection):
-    if db_connection.type == 'mysql':
-        config = db_connection.config
-        host = config.get('host', 'localhost')
-        port = int(config.get('port', 3306))
-        user = config.get('user', '')
-        password = config.get('password', '')
-        database = config.get('database', '')
-        
-        if ':' in host:
-            host = host.split(':')[0]
-        
-        if host in ['localhost', '127.0.0.1']:
-             host = 'host.docker.internal'
-
-        encoded_password = quote_plus(password)
-        
-        db_uri = f"mysql+pymysql://{user}:{encoded_password}@{host}:{port}/{database}"
-        
-        return create_engine(db_uri)
-    
-    elif db_connection.type == 'csv':
-        import io
-        
+CSV_CACHE_DIR = os.getenv("CSV_CACHE_DIR", os.path.join(tempfile.gettempdir(), "csv-cache"))
+CSV_CACHE_MAX_BYTES = int(os.getenv("CSV_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+CSV_CACHE_MAX_AGE = int(os.getenv("CSV_CACHE_MAX_AGE", 7 * 24 * 3600))
+CSV_ENGINE_CACHE_SIZE = 16
+
+# Recently used engines are held in an LRU; any engine still referenced
+# elsewhere (e.g. by the chain cache) stays reachable through the weak map,
+# and only those have their cache files protected from pruning.
+_csv_engines = OrderedDict()
+_live_csv_engines = weakref.WeakValueDictionary()
+_csv_engines_lock = threading.Lock()
+
+MYSQL_ENGINE_CACHE_SIZE = 32
+_mysql_engines = OrderedDict()
+_mysql_engines_lock = threading.Lock()
+
+def connection_fingerprint(db_connection: DBConnection):
+    payload = json.dumps(
+        {"type": db_connection.type, "config": db_connection.config},
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def bulk_insert_dataframe(engine, df, table_name):
+    create_sql = pd.io.sql.get_schema(df, table_name, con=engine)
+    placeholders = ", ".join(["?"] * len(df.columns))
+    rows = df.astype(object).where(df.notna(), None).values.tolist()
+
+    raw_connection = engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.executescript("PRAGMA synchronous=OFF; PRAGMA journal_mode=MEMORY; PRAGMA temp_store=MEMORY;")
+        cursor.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        cursor.execute(create_sql)
+        cursor.executemany(f'INSERT INTO "{table_name}" VALUES ({placeholders})', rows)
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+
+def resolve_csv_path(config):
+    csv_path = config.get('csvPath')
+    if not csv_path:
+         raise ValueError("CSV path or content required")
+    filename = os.path.basename(csv_path)
+    full_path = f"/app/uploads/{filename}"
+    if not os.path.exists(full_path):
+         if os.path.exists(csv_path):
+             full_path = csv_path
+         else:
+             raise ValueError(f"CSV file not found at {full_path}")
+    return full_path
+
+def csv_fingerprint(config):
+    digest = hashlib.sha256()
+    if 'csvContent' in config:
+        digest.update(config['csvContent'].encode())
+    else:
+        with open(resolve_csv_path(config), 'rb') as csv_file:
+            for chunk in iter(lambda: csv_file.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+# pandas.read_csv's default NA markers; pyarrow's defaults lack "None" and "<NA>".
+CSV_NULL_VALUES = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+]
+
+def _csv_source(config):
+    if 'csvContent' in config:
+        return pa.BufferReader(config['csvContent'].encode())
+    return resolve_csv_path(config)
+
+def _dedupe_column_names(names):
+    # Same header handling as pandas.read_csv: blank headers become
+    # "Unnamed: <i>" and repeated headers get the next ".N" suffix not
+    # already used elsewhere in the header.
+    names = [name or f"Unnamed: {index}" for index, name in enumerate(names)]
+    counts = {}
+    deduped = []
+    for name in names:
+        base = name
+        count = counts.get(base, 0)
+        while count > 0:
+            counts[base] = count + 1
+            name = f"{base}.{count}"
+            count = count + 1 if name in names else counts.get(name, 0)
+        deduped.append(name)
+        counts[name] = count + 1
+    return deduped
+
+def read_csv_table(config):
+    table = pacsv.read_csv(
+        _csv_source(config),
+        convert_options=pacsv.ConvertOptions(null_values=CSV_NULL_VALUES, strings_can_be_null=True)
+    )
+    column_names = _dedupe_column_names(table.column_names)
+    temporal_columns = [name for name, field in zip(column_names, table.schema) if pa.types.is_temporal(field.type)]
+    if not temporal_columns:
+        return table.rename_columns(column_names)
+
+    # pyarrow normalises the timestamps it parses; re-read those columns as
+    # strings so the stored values are the text from the file.
+    del table
+    return pacsv.read_csv(
+        _csv_source(config),
+        read_options=pacsv.ReadOptions(column_names=column_names, skip_rows=1),
+        convert_options=pacsv.ConvertOptions(
+            null_values=CSV_NULL_VALUES,
+            strings_can_be_null=True,
+            column_types={name: pa.string() for name in temporal_columns}
+        )
+    )
+
+def ingest_csv(config, engine):
+    try:
+        table = read_csv_table(config)
+    except pa.ArrowInvalid as e:
+        # pyarrow rejects rows with fewer fields than the header, which
+        # pandas pads with NULLs.
+        print(f"Falling back to pandas CSV parser: {e}")
+        source = io.StringIO(config['csvContent']) if 'csvContent' in config else resolve_csv_path(config)
+        df = pd.read_csv(source)
+    else:
+        df = table.to_pandas(split_blocks=True, self_destruct=True)
+        del table
+    bulk_insert_dataframe(engine, df, "data")
+
+def build_csv_cache(config, db_path):
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    with open(f"{db_path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(db_path):
+                return
+            tmp_path = f"{db_path}.{os.getpid()}.tmp"
+            tmp_engine = create_engine(f"sqlite:///{tmp_path}")
+            try:
+                ingest_csv(config, tmp_engine)
+                tmp_engine.dispose()
+                # The bulk load runs with synchronous=OFF; make it durable
+                # before the file is trusted as a cache entry.
+                with open(tmp_path, 'rb') as tmp_file:
+                    os.fsync(tmp_file.fileno())
+                os.replace(tmp_path, db_path)
+            finally:
+                tmp_engine.dispose()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def prune_csv_cache(keep):
+    # Drop cache files unused for CSV_CACHE_MAX_AGE, then the least recently
+    # used ones until the directory fits in CSV_CACHE_MAX_BYTES. Fingerprints
+    # in keep back live engines and are never removed.
+    entries = []
+    try:
+        for entry in os.scandir(CSV_CACHE_DIR):
+            if entry.name.endswith(".db"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError as e:
+        print(f"Error scanning CSV cache: {e}")
+        return
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    now = time.time()
+    for mtime, size, path in entries:
+        if now - mtime <= CSV_CACHE_MAX_AGE and total <= CSV_CACHE_MAX_BYTES:
+            break
+        if os.path.basename(path)[:-len(".db")] in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            os.remove(f"{path}.lock")
+        except OSError:
+            pass
+
+def _is_memory_engine(engine):
+    return engine.url.database.startswith("file:mem_")
+
+def _remember_csv_engine(fingerprint, engine):
+    with _csv_engines_lock:
+        engine = _live_csv_engines.setdefault(fingerprint, engine)
+        _csv_engines[fingerprint] = engine
+        _csv_engines.move_to_end(fingerprint)
+        evicted = []
+        while len(_csv_engines) > CSV_ENGINE_CACHE_SIZE:
+            evicted.append(_csv_engines.popitem(last=False)[1])
+
+    for old_engine in evicted:
+        old_engine.dispose()
+        if not _is_memory_engine(old_engine):
+            try:
+                os.utime(old_engine.url.database)
+            except OSError:
+                pass
+    return engine
+
+def load_csv_to_engine(config):
+    fingerprint = csv_fingerprint(config)
+    with _csv_engines_lock:
+        engine = _live_csv_engines.get(fingerprint)
+        if engine is not None and not _is_memory_engine(engine) and not os.path.exists(engine.url.database):
+            # Pruned by another worker; reconnecting would create an empty database.
+            _csv_engines.pop(fingerprint, None)
+            del _live_csv_engines[fingerprint]
+            engine.dispose()
+            engine = None
+    if engine is not None:
+        return _remember_csv_engine(fingerprint, engine)
+
+    db_path = os.path.join(CSV_CACHE_DIR, f"{fingerprint}.db")
+    try:
+        try:
+            os.utime(db_path)
+        except FileNotFoundError:
+            build_csv_cache(config, db_path)
+            with _csv_engines_lock:
+                live = set(_live_csv_engines.keys())
+            prune_csv_cache(live | {fingerprint})
+        engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    except OSError as e:
+        print(f"CSV cache unavailable, loading into memory: {e}")
+        memory_uri = f"file:mem_{fingerprint}?mode=memory&cache=shared"
+        keeper = sqlite3.connect(memory_uri, uri=True, check_same_thread=False)
         engine = create_engine(
-            "sqlite://", 
-            poolclass=StaticPool,
+            f"sqlite:///{memory_uri}&uri=true",
             connect_args={"check_same_thread": False}
         )
+        ingest_csv(config, engine)
+        # The shared in-memory database lives as long as a connection to it
+        # is open, so the keeper goes when the engine is no longer referenced.
+        weakref.finalize(engine, keeper.close)
+
+    return _remember_csv_engine(fingerprint, engine)
+
+def build_mysql_uri(config):
+    host = config.get('host', 'localhost')
+    port = int(config.get('port', 3306))
+    user = config.get('user', '')
+    password = config.get('password', '')
+    database = config.get('database', '')
+    
+    if ':' in host:
+        host = host.split(':')[0]
+    
+    if host in ['localhost', '127.0.0.1']:
+         host = 'host.docker.internal'
+
+    encoded_password = quote_plus(password)
+    
+    return f"mysql+pymysql://{user}:{encoded_password}@{host}:{port}/{database}"
 
-        if 'csvContent' in db_connection.config:
-            csv_content = db_connection.config['csvContent']
-            df = pd.read_csv(io.StringIO(csv_content))
+def get_mysql_engine(config):
+    db_uri = build_mysql_uri(config)
+    key = hashlib.sha256(db_uri.encode()).hexdigest()
+
+    evicted = None
+    with _mysql_engines_lock:
+        engine = _mysql_engines.get(key)
+        if engine is None:
+            engine = create_engine(
+                db_uri,
+                pool_size=10,
+                max_overflow=20,
+                pool_pre_ping=True,
+                pool_recycle=1800
+            )
+            _mysql_engines[key] = engine
+            if len(_mysql_engines) > MYSQL_ENGINE_CACHE_SIZE:
+                _, evicted = _mysql_engines.popitem(last=False)
         else:
-            csv_path = db_connection.config.get('csvPath')
-            if not csv_path:
-                 raise ValueError("CSV path or content required")
-            filename = os.path.basename(csv_path)
-            full_path = f"/app/uploads/{filename}"
-            if not os.path.exists(full_path):
-                 if os.path.exists(csv_path):
-                     full_path = csv_path
-                 else:
-                     raise ValueError(f"CSV file not found at {full_path}")
-            
-            df = pd.read_csv(full_path)
-        
-        df.to_sql("data", engine, index=False, if_exists='replace')
-        
-        return engine
+            _mysql_engines.move_to_end(key)
+
+    if evicted is not None:
+        evicted.dispose()
+    return engine
+
+def get_engine(db_connection: DBConnection):
+    if db_connection.type == 'mysql':
+        return get_mysql_engine(db_connection.config)
+    
+    elif db_connection.type == 'csv':
+        return load_csv_to_engine(db_connection.config)
 
     else:
         raise ValueError("Invalid database type")
+
+class CachedSQLDatabase(SQLDatabase):
+    # create_sql_query_chain renders table_info (including sample rows) on
+    # every invoke; render it once per table selection instead.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._table_info_cache = {}
+        self._table_info_lock = threading.Lock()
+
+    def get_table_info(self, table_names=None):
+        key = tuple(sorted(table_names)) if table_names else None
+        with self._table_info_lock:
+            if key in self._table_info_cache:
+                return self._table_info_cache[key]
+        table_info = super().get_table_info(table_names)
+        with self._table_info_lock:
+            return self._table_info_cache.setdefault(key, table_info)
+
+    def clear_table_info_cache(self):
+        with self._table_info_lock:
+            self._table_info_cache.clear()
+
+def get_db(db_connection: DBConnection):
+    return CachedSQLDatabase(get_engine(db_connection))
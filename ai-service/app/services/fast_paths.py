@@ -0,0 +1,73 @@
+import re
+from ..models import DBConnection
+from .schema_inspection import get_schema_info_service
+
+_TABLE_REF = r"(?:the\s+)?(?:table\s+)?[`\"']?(\w+)[`\"']?(?:\s+table)?"
+
+def _quote_identifier(dialect: str, name: str):
+    if dialect == 'mysql':
+        return "`" + name.replace("`", "``") + "`"
+    return '"' + name.replace('"', '""') + '"'
+
+def _quote_literal(value: str):
+    return "'" + value.replace("'", "''") + "'"
+
+def _list_tables_sql(dialect: str, table_name=None):
+    if dialect == 'mysql':
+        return "SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE();"
+    return "SELECT name FROM sqlite_master WHERE type='table';"
+
+def _describe_table_sql(dialect: str, table_name: str):
+    if dialect == 'mysql':
+        return (
+            "SELECT column_name, column_type FROM information_schema.columns "
+            f"WHERE table_schema = DATABASE() AND table_name = {_quote_literal(table_name)} "
+            "ORDER BY ordinal_position;"
+        )
+    return f"SELECT name, type FROM pragma_table_info({_quote_literal(table_name)});"
+
+def _row_count_sql(dialect: str, table_name: str):
+    return f"SELECT COUNT(*) AS row_count FROM {_quote_identifier(dialect, table_name)};"
+
+_FAST_PATHS = [
+    (
+        re.compile(r"^(?:list|show|get|display)(?:\s+me)?(?:\s+all)?(?:\s+the)?\s+tables?(?:\s+names?)?$", re.IGNORECASE),
+        _list_tables_sql
+    ),
+    (
+        re.compile(r"^(?:what\s+are\s+)?(?:all\s+)?(?:the\s+)?table\s+names$", re.IGNORECASE),
+        _list_tables_sql
+    ),
+    (
+        re.compile(rf"^(?:describe|desc|(?:list|show)(?:\s+me)?(?:\s+the)?\s+columns\s+(?:of|in|for))\s+{_TABLE_REF}$", re.IGNORECASE),
+        _describe_table_sql
+    ),
+    (
+        re.compile(rf"^(?:(?:the\s+)?row\s+count\s+(?:of|for|in)|how\s+many\s+rows\s+(?:are\s+)?(?:there\s+)?in|count\s+(?:the\s+)?rows\s+(?:of|in))\s+{_TABLE_REF}$", re.IGNORECASE),
+        _row_count_sql
+    ),
+]
+
+def _resolve_table_name(db_connection: DBConnection, name: str):
+    table_names = [table["name"] for table in get_schema_info_service(db_connection)["tables"]]
+    for table_name in table_names:
+        if table_name.lower() == name.lower():
+            return table_name
+    return None
+
+def match_fast_path(question: str, db_connection: DBConnection):
+    normalized = re.sub(r"\s+", " ", question).strip().rstrip("?.!").strip()
+    dialect = 'mysql' if db_connection.type == 'mysql' else 'sqlite'
+
+    for pattern, build_sql in _FAST_PATHS:
+        match = pattern.match(normalized)
+        if not match:
+            continue
+        if not match.groups():
+            return build_sql(dialect)
+        table_name = _resolve_table_name(db_connection, match.group(1))
+        if table_name is None:
+            return None
+        return build_sql(dialect, table_name)
+
+    return None
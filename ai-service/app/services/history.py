@@ -0,0 +1,56 @@
+import re
+from ..models import HistoryMessage
+
+HISTORY_MAX_TOKENS = 4000
+SUMMARY_MAX_TOKENS = 400
+
+_ROLE_NAMES = {"user": "User", "human": "User", "ai": "AI", "assistant": "AI"}
+_LEGACY_TURN_RE = re.compile(r"^\s*(User|AI)\s*:\s*", re.IGNORECASE)
+
+def _estimate_tokens(text: str):
+    return len(text) // 4 + 1
+
+def _normalize_turn(turn):
+    if isinstance(turn, HistoryMessage):
+        role, content = turn.role, turn.content
+    else:
+        match = _LEGACY_TURN_RE.match(turn)
+        role, content = (match.group(1), turn[match.end():]) if match else ("User", turn)
+    role = _ROLE_NAMES.get(role.strip().lower(), role.strip())
+    return role, re.sub(r"\s+", " ", content).strip()
+
+class HistoryBuffer:
+    def __init__(self, max_tokens: int = HISTORY_MAX_TOKENS):
+        self.max_tokens = max_tokens
+
+    def lines(self, history):
+        turns = [f"{role}: {content}" for role, content in map(_normalize_turn, history or [])]
+
+        budget = self.max_tokens - SUMMARY_MAX_TOKENS
+        kept = []
+        used = 0
+        for line in reversed(turns):
+            cost = _estimate_tokens(line)
+            if used + cost > budget:
+                if kept:
+                    break
+                line = line[:(budget - 1) * 4 - 3] + "..."
+                cost = _estimate_tokens(line)
+            kept.append(line)
+            used += cost
+        kept.reverse()
+
+        dropped = turns[:len(turns) - len(kept)]
+        if not dropped:
+            return kept
+
+        earlier_questions = [line[len("User: "):] for line in dropped if line.startswith("User: ")]
+        summary = "[summary] Earlier the user asked: " + "; ".join(earlier_questions or ["(no questions)"])
+        max_chars = SUMMARY_MAX_TOKENS * 4
+        if len(summary) > max_chars:
+            summary = summary[:max_chars - 3] + "..."
+        return [summary] + kept
+
+    def render(self, history):
+        lines = self.lines(history)
+        return "\n".join(lines) if lines else "No previous history."
@@ -0,0 +1,90 @@
+import os
+import datetime
+import threading
+import google.generativeai as genai
+from google.generativeai import caching
+
+api_key = os.getenv("GOOGLE_API_KEY")
+genai.configure(api_key=api_key)
+
+PROMPT_CACHE_TTL = datetime.timedelta(hours=1)
+PROMPT_CACHE_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+_cached_models = {}
+_cached_models_lock = threading.Lock()
+_refresh_locks = {}
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+def _delete_content(cached_content):
+    if cached_content is None:
+        return
+    try:
+        cached_content.delete()
+    except Exception as e:
+        print(f"Error deleting prompt cache: {e}")
+
+def _refresh_lock(fingerprint: str):
+    with _cached_models_lock:
+        return _refresh_locks.setdefault(fingerprint, threading.Lock())
+
+def _create_cached_model(model_name: str, system_prompt: str, load_table_info):
+    cached_content = None
+    try:
+        cached_content = caching.CachedContent.create(
+            model=f"models/{model_name}",
+            system_instruction=system_prompt,
+            contents=[f"Only use the following tables:\n{load_table_info()}"],
+            ttl=PROMPT_CACHE_TTL
+        )
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content), cached_content
+    except Exception as e:
+        print(f"Prompt caching unavailable, using full prompts: {e}")
+        _delete_content(cached_content)
+        return None, None
+
+def get_cached_model(fingerprint: str, model_name: str, system_prompt: str, load_table_info):
+    with _cached_models_lock:
+        entry = _cached_models.get(fingerprint)
+    if entry and entry["expires_at"] - PROMPT_CACHE_REFRESH_MARGIN > _now():
+        return entry["model"]
+
+    # One request per fingerprint builds the cache; while it does, others keep
+    # using the current entry if it hasn't expired, or wait for the new one.
+    refresh_lock = _refresh_lock(fingerprint)
+    if not refresh_lock.acquire(blocking=False):
+        if entry and entry["expires_at"] > _now():
+            return entry["model"]
+        refresh_lock.acquire()
+    try:
+        with _cached_models_lock:
+            entry = _cached_models.get(fingerprint)
+        if entry and entry["expires_at"] - PROMPT_CACHE_REFRESH_MARGIN > _now():
+            return entry["model"]
+
+        model, cached_content = _create_cached_model(model_name, system_prompt, load_table_info)
+        # A replaced cache may still be serving in-flight requests, so it is
+        # left to expire through its TTL rather than deleted here.
+        with _cached_models_lock:
+            _cached_models[fingerprint] = {
+                "model": model,
+                "content": cached_content,
+                "expires_at": _now() + PROMPT_CACHE_TTL
+            }
+        return model
+    finally:
+        refresh_lock.release()
+
+def generate_with_cached_model(model, prompt: str):
+    response = model.generate_content(
+        prompt,
+        generation_config={"temperature": 0, "stop_sequences": ["\nSQLResult:"]}
+    )
+    return response.text
+
+def invalidate(fingerprint: str):
+    with _cached_models_lock:
+        entry = _cached_models.pop(fingerprint, None)
+    if entry:
+        _delete_content(entry["content"])
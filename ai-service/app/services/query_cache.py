@@ -0,0 +1,35 @@
+import re
+import hashlib
+import threading
+from cachetools import TTLCache
+
+RESPONSE_CACHE_SIZE = 10_000
+RESPONSE_CACHE_TTL = 1800
+
+_response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+_response_cache_lock = threading.Lock()
+
+def normalize_question(question: str):
+    return re.sub(r"\s+", " ", question).strip().lower()
+
+def response_cache_key(db_fingerprint: str, question: str, history=None):
+    parts = [normalize_question(question)]
+    if history:
+        parts.extend(normalize_question(str(turn)) for turn in history)
+    digest = hashlib.sha256("|".join(parts).encode()).hexdigest()
+    return (db_fingerprint, digest)
+
+def get_cached_response(key):
+    with _response_cache_lock:
+        return _response_cache.get(key)
+
+def set_cached_response(key, payload):
+    with _response_cache_lock:
+        _response_cache[key] = payload
+
+def invalidate_responses(db_fingerprint: str):
+    with _response_cache_lock:
+        stale_keys = [key for key in _response_cache.keys() if key[0] == db_fingerprint]
+        for key in stale_keys:
+            _response_cache.pop(key, None)
+    return len(stale_keys)
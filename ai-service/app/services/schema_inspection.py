@@ -1,56 +1,134 @@
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text
 from ..models import DBConnection
-from .db_utils import get_engine
+from .db_utils import get_engine, connection_fingerprint
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from langchain_google_genai import ChatGoogleGenerativeAI
 import os
 
 api_key = os.getenv("GOOGLE_API_KEY")
 llm = ChatGoogleGenerativeAI(model="gemini-flash-latest", temperature=0, google_api_key=api_key)
 
-def get_schema_info_service(db_connection: DBConnection):
-    engine = get_engine(db_connection)
+SCHEMA_CACHE_SIZE = 128
+SCHEMA_CACHE_TTL = 300
+INTROSPECTION_WORKERS = 16
+
+_introspection_executor = ThreadPoolExecutor(max_workers=INTROSPECTION_WORKERS)
+
+MYSQL_COLUMNS_QUERY = text("""
+    SELECT c.TABLE_NAME AS table_name, c.COLUMN_NAME AS column_name, c.COLUMN_TYPE AS column_type
+    FROM information_schema.COLUMNS c
+    JOIN information_schema.TABLES t
+        ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+    WHERE c.TABLE_SCHEMA = DATABASE() AND t.TABLE_TYPE = 'BASE TABLE'
+    ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+""")
+
+MYSQL_FOREIGN_KEYS_QUERY = text("""
+    SELECT TABLE_NAME AS table_name, CONSTRAINT_NAME AS constraint_name, COLUMN_NAME AS column_name,
+        REFERENCED_TABLE_NAME AS referred_table, REFERENCED_COLUMN_NAME AS referred_column
+    FROM information_schema.KEY_COLUMN_USAGE
+    WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+    ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION
+""")
+
+def _fetch_rows(engine, query):
+    with engine.connect() as connection:
+        return connection.execute(query).mappings().all()
+
+def _load_mysql_schema(engine):
+    # Only the foreign-key query goes to the shared pool; the columns query
+    # runs on the calling thread, so a slow host mostly ties up its own
+    # request rather than the pool every schema load depends on.
+    fks_future = _introspection_executor.submit(_fetch_rows, engine, MYSQL_FOREIGN_KEYS_QUERY)
+    column_rows = _fetch_rows(engine, MYSQL_COLUMNS_QUERY)
+    fk_rows = fks_future.result()
+
+    tables = {}
+    for row in column_rows:
+        tables.setdefault(row['table_name'], []).append({
+            "name": row['column_name'],
+            "type": row['column_type'].upper()
+        })
+
+    relationships = {}
+    for row in fk_rows:
+        relationship = relationships.setdefault((row['table_name'], row['constraint_name']), {
+            "from": row['table_name'],
+            "to": row['referred_table'],
+            "cols": [],
+            "refCols": []
+        })
+        relationship["cols"].append(row['column_name'])
+        relationship["refCols"].append(row['referred_column'])
+
+    return {
+        "tables": [{"name": name, "columns": columns} for name, columns in tables.items()],
+        "relationships": list(relationships.values())
+    }
+
+def _inspect_table(engine, table_name):
     inspector = inspect(engine)
-    table_names = inspector.get_table_names()
+    columns = []
+    for col in inspector.get_columns(table_name):
+        columns.append({
+            "name": col['name'],
+            "type": str(col['type'])
+        })
     
-    tables = []
     relationships = []
-    
-    for table_name in table_names:
-        columns = []
-        for col in inspector.get_columns(table_name):
-            columns.append({
-                "name": col['name'],
-                "type": str(col['type'])
+    try:
+        fks = inspector.get_foreign_keys(table_name)
+        for fk in fks:
+            relationships.append({
+                "from": table_name,
+                "to": fk['referred_table'],
+                "cols": fk['constrained_columns'],
+                "refCols": fk['referred_columns']
             })
-        tables.append({
-            "name": table_name,
-            "columns": columns
-        })
-        
-        try:
-            fks = inspector.get_foreign_keys(table_name)
-            for fk in fks:
-                relationships.append({
-                    "from": table_name,
-                    "to": fk['referred_table'],
-                    "cols": fk['constrained_columns'],
-                    "refCols": fk['referred_columns']
-                })
-        except Exception as e:
-            print(f"Error fetching foreign keys for {table_name}: {e}")
+    except Exception as e:
+        print(f"Error fetching foreign keys for {table_name}: {e}")
+
+    return {"name": table_name, "columns": columns}, relationships
+
+def _load_inspected_schema(engine):
+    tables = []
+    relationships = []
+    for table_name in inspect(engine).get_table_names():
+        table, table_relationships = _inspect_table(engine, table_name)
+        tables.append(table)
+        relationships.extend(table_relationships)
         
     return {"tables": tables, "relationships": relationships}
 
-def suggest_questions_service(db_connection: DBConnection):
+@cached(
+    TTLCache(maxsize=SCHEMA_CACHE_SIZE, ttl=SCHEMA_CACHE_TTL),
+    key=lambda fingerprint, engine: hashkey(fingerprint),
+    lock=threading.Lock()
+)
+def _load_schema(fingerprint, engine):
+    if engine.dialect.name == 'mysql':
+        return _load_mysql_schema(engine)
+    return _load_inspected_schema(engine)
+
+def get_schema_info_service(db_connection: DBConnection):
     engine = get_engine(db_connection)
-    inspector = inspect(engine)
-    table_names = inspector.get_table_names()
+    return _load_schema(connection_fingerprint(db_connection), engine)
+
+def invalidate_schema(db_connection: DBConnection):
+    with _load_schema.cache_lock:
+        _load_schema.cache.pop(hashkey(connection_fingerprint(db_connection)), None)
+
+def suggest_questions_service(db_connection: DBConnection):
+    schema = get_schema_info_service(db_connection)
     
     schema_summary = []
-    for table_name in table_names:
-        columns = [col['name'] for col in inspector.get_columns(table_name)]
-        schema_summary.append(f"Table: {table_name}, Columns: {', '.join(columns)}")
+    for table in schema["tables"]:
+        columns = [col['name'] for col in table["columns"]]
+        schema_summary.append(f"Table: {table['name']}, Columns: {', '.join(columns)}")
     
     schema_str = "\n".join(schema_summary)
     
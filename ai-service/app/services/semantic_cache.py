@@ -0,0 +1,119 @@
+import os
+import re
+import threading
+import numpy as np
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+api_key = os.getenv("GOOGLE_API_KEY")
+embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004", google_api_key=api_key)
+
+SEMANTIC_CACHE_SIZE = 1000
+REUSE_THRESHOLD = 0.92
+EXEMPLAR_THRESHOLD = 0.80
+
+_STRING_RE = re.compile(r"'([^']*)'|\"([^\"]*)\"")
+_NUMBER_RE = re.compile(r"(?<![\w.])\d+(?:\.\d+)?(?![\w.])")
+_ENTITY_RE = re.compile(r"(?<!^)(?<![.?!]\s)\b[A-Z][\w-]*(?:\s+[A-Z][\w-]*)*")
+
+_entries = {}
+_entries_lock = threading.Lock()
+
+def skeletonize(question: str):
+    entities = []
+
+    def capture(placeholder):
+        def replace(match):
+            value = next((group for group in match.groups() if group is not None), match.group(0))
+            entities.append(value)
+            return placeholder
+        return replace
+
+    skeleton = _STRING_RE.sub(capture("<str>"), question.strip())
+    skeleton = _NUMBER_RE.sub(capture("<num>"), skeleton)
+    skeleton = _ENTITY_RE.sub(capture("<ent>"), skeleton)
+    skeleton = re.sub(r"\s+", " ", skeleton).lower()
+    return skeleton, entities
+
+def _embed(skeleton: str):
+    vector = np.asarray(embeddings.embed_query(skeleton), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def substitute_entities(sql: str, old_entities, new_entities):
+    if len(old_entities) != len(new_entities):
+        return None
+
+    mapping = {}
+    for old, new in zip(old_entities, new_entities):
+        if mapping.setdefault(old, new) != new:
+            return None
+
+    mapping = {old: new for old, new in mapping.items() if old != new}
+    if not mapping:
+        return sql
+
+    # One pass so a substituted value is never rewritten again. Each literal
+    # must occur exactly once; otherwise we can't tell which occurrence came
+    # from the question and the LLM has to handle it.
+    alternation = "|".join(re.escape(old) for old in sorted(mapping, key=len, reverse=True))
+    pattern = re.compile(rf"(?<![\w.])(?:{alternation})(?![\w.])")
+    found = [match.group(0) for match in pattern.finditer(sql)]
+    if sorted(found) != sorted(mapping):
+        return None
+    return pattern.sub(lambda match: mapping[match.group(0)], sql)
+
+def lookup(db_fingerprint: str, question: str):
+    skeleton, entities = skeletonize(question)
+    try:
+        vector = _embed(skeleton)
+    except Exception as e:
+        print(f"Error embedding question for semantic cache: {e}")
+        return None
+
+    match = {"vector": vector, "skeleton": skeleton, "entities": entities, "similarity": 0.0}
+    with _entries_lock:
+        stored = _entries.get(db_fingerprint)
+        if not stored:
+            return match
+        vectors = np.stack([entry["vector"] for entry in stored])
+        scores = vectors @ vector
+        best = int(np.argmax(scores))
+        match["similarity"] = float(scores[best])
+        match["entry"] = stored[best]
+    return match
+
+def adapt_cached_sql(match):
+    if not match or match["similarity"] < REUSE_THRESHOLD:
+        return None
+    entry = match["entry"]
+    # Similar embeddings aren't enough to run the SQL unchecked; the questions
+    # may only differ in their captured literals. Otherwise it's an exemplar.
+    if entry["skeleton"] != match["skeleton"]:
+        return None
+    return substitute_entities(entry["sql"], entry["entities"], match["entities"])
+
+def exemplar_sql(match):
+    if not match or match["similarity"] < EXEMPLAR_THRESHOLD:
+        return None
+    return match["entry"]["sql"]
+
+def store(db_fingerprint: str, match, sql: str):
+    if not match:
+        return
+    entry = {
+        "vector": match["vector"],
+        "skeleton": match["skeleton"],
+        "entities": match["entities"],
+        "sql": sql
+    }
+    with _entries_lock:
+        stored = _entries.setdefault(db_fingerprint, [])
+        if any(existing["skeleton"] == entry["skeleton"] and existing["entities"] == entry["entities"] for existing in stored):
+            return
+        stored.append(entry)
+        if len(stored) > SEMANTIC_CACHE_SIZE:
+            del stored[0]
+
+def invalidate(db_fingerprint: str):
+    with _entries_lock:
+        _entries.pop(db_fingerprint, None)
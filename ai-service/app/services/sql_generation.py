@@ -1,121 +1,453 @@
 import re
+import asyncio
+import difflib
 import datetime
+import threading
+import orjson
+import pandas as pd
+import sqlglot
+from sqlglot import exp
+from sqlglot.tokens import TokenType
 from decimal import Decimal
 from sqlalchemy import text
-from langchain_community.utilities import SQLDatabase
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.chains import create_sql_query_chain
 from langchain_core.prompts import PromptTemplate
 from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
 import os
-from ..models import QueryRequest
-from .db_utils import get_engine
+from collections import OrderedDict
+from ..models import DBConnection, QueryRequest
+from .db_utils import get_engine, get_db, connection_fingerprint
+from .query_cache import response_cache_key, get_cached_response, set_cached_response, invalidate_responses
+from . import semantic_cache
+from .fast_paths import match_fast_path
+from .schema_inspection import get_schema_info_service
+from .history import HistoryBuffer
+from . import prompt_cache
 
 api_key = os.getenv("GOOGLE_API_KEY")
-llm = ChatGoogleGenerativeAI(model="gemini-flash-latest", temperature=0, google_api_key=api_key)
+CHEAP_MODEL = "gemini-flash-lite-latest"
+STRONG_MODEL = "gemini-pro-latest"
+cheap_llm = ChatGoogleGenerativeAI(model=CHEAP_MODEL, temperature=0, google_api_key=api_key)
+strong_llm = ChatGoogleGenerativeAI(model=STRONG_MODEL, temperature=0, google_api_key=api_key)
+
+_CODE_BLOCK_RE = re.compile(r"```(?:sqlite|mysql|sql)?\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+_SQL_PREFIX_RE = re.compile(r"^.*?SQLQuery:", re.DOTALL)
+_COMPLEX_QUESTION_RE = re.compile(
+    r"\b(?:group(?:ed)? by|average|avg|median|ratio|percent(?:age)?|rank(?:ed|ing)?|cumulative|running total"
+    r"|compared? to|versus|year over year|month over month|(?:more|less|higher|lower) than (?:the )?average"
+    r"|(?:that|who) never|without any|not in any)\b",
+    re.IGNORECASE
+)
+_WEAK_COMPLEX_CUE_RE = re.compile(r"\b(?:per|each|vs|both|except|(?:that|who) (?:have|has))\b", re.IGNORECASE)
+COMPLEX_QUESTION_LENGTH = 200
+_MISSING_OBJECT_RES = [
+    re.compile(r"Unknown column '([^']+)'", re.IGNORECASE),
+    re.compile(r"no such column: ([\w.`\"]+)", re.IGNORECASE),
+    re.compile(r"Table '(?:[^'.]+\.)?([^']+)' doesn't exist", re.IGNORECASE),
+    re.compile(r"no such table: ([\w.`\"]+)", re.IGNORECASE),
+]
+_PERMISSION_ERROR_RE = re.compile(
+    r"permission denied|access denied|command denied|not authorized|attempt to write a readonly database",
+    re.IGNORECASE
+)
+_SYNTAX_ERROR_RE = re.compile(
+    r"syntax error|error in your SQL syntax|Expected a single SQL statement|Only SELECT queries",
+    re.IGNORECASE
+)
+SYNTAX_ERROR_MAX_ATTEMPTS = 2
+
+MAX_RESULT_ROWS = 1000
+STREAM_CHUNK_SIZE = 1000
+SQL_TOP_K = 100
+CHAIN_CACHE_SIZE = 64
+_chain_cache = OrderedDict()
+_chain_cache_lock = threading.Lock()
 
 def serialize_value(value):
-    if isinstance(value, (datetime.date, datetime.datetime)):
-        return value.isoformat()
     if isinstance(value, Decimal):
         return float(value)
-    return value
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
 
-async def generate_sql_response(request: QueryRequest):
-    try:
-        engine = get_engine(request.db_connection)
-        db = SQLDatabase(engine)
-        
-        db_name = request.db_connection.config.get('database', 'data') if request.db_connection.type == 'mysql' else 'data'
-        db_type = request.db_connection.type
-
-        if db_type == 'mysql':
-            system_prompt = f"""You are a MySQL expert. Given an input question, create a syntactically correct MySQL query to run.
-            Unless the user specifies otherwise, obtain the relevant data from the database.
-            
-            Important:
-            - If the user asks for "all table names", you MUST query the `information_schema.tables` table.
-            - Example: SELECT table_name FROM information_schema.tables WHERE table_schema = '{db_name}';
-            - Never query for all columns from a specific table, only ask for a few relevant columns given the question.
-            - Pay attention to use only the column names you can see in the tables below. Be careful to not query for columns that do not exist.
-            - Also, pay attention to which column is in which table.
-            - CRITICAL: Generate a SINGLE SQL query. Do NOT generate multiple queries separated by semicolons.
-            """
-        else:
-            system_prompt = f"""You are a SQLite expert. Given an input question, create a syntactically correct SQLite query to run.
-            Unless the user specifies otherwise, obtain the relevant data from the database.
-            
-            Important:
-            - If the user asks for "all table names", you MUST query the `sqlite_master` table.
-            - Example: SELECT name FROM sqlite_master WHERE type='table';
-            - Never query for all columns from a specific table, only ask for a few relevant columns given the question.
-            - Pay attention to use only the column names you can see in the tables below. Be careful to not query for columns that do not exist.
-            - Also, pay attention to which column is in which table.
-            - CRITICAL: Generate a SINGLE SQL query. Do NOT generate multiple queries separated by semicolons.
-            """
-        
-        chat_history_str = "\n".join(request.history) if request.history else "No previous history."
-        
-        full_prompt_template = system_prompt + f"""
-        
-        Previous Conversation History:
-        {chat_history_str}
-        
-        Only use the following tables:
-        {{table_info}}
-        
-        Question: {{input}}
+def json_response(payload):
+    return Response(content=orjson.dumps(payload, default=serialize_value), media_type="application/json")
+
+def clean_sql(response: str):
+    match = _CODE_BLOCK_RE.search(response)
+    if match:
+        response = match.group(1)
+    return _SQL_PREFIX_RE.sub("", response, count=1).strip()
+
+def is_complex_question(question: str):
+    if len(question) > COMPLEX_QUESTION_LENGTH:
+        return True
+    if _COMPLEX_QUESTION_RE.search(question):
+        return True
+    # Cues like "each" or "per" are common in simple lookups, so one alone
+    # doesn't justify the stronger model.
+    if len(_WEAK_COMPLEX_CUE_RE.findall(question)) >= 2:
+        return True
+    clauses = len(re.findall(r"\b(?:and|or|where|when|then)\b|,", question, re.IGNORECASE))
+    return clauses >= 3
+
+def _top_level_limit_token(tokens):
+    # The row-count token of the last LIMIT outside parentheses; MySQL's
+    # "LIMIT offset, count" puts it after the comma.
+    depth = 0
+    limit_index = None
+    for index, token in enumerate(tokens):
+        if token.token_type == TokenType.L_PAREN:
+            depth += 1
+        elif token.token_type == TokenType.R_PAREN:
+            depth -= 1
+        elif token.token_type == TokenType.LIMIT and depth == 0:
+            limit_index = index
+
+    if limit_index is None:
+        return None
+    value_index = limit_index + 1
+    if value_index + 1 < len(tokens) and tokens[value_index + 1].token_type == TokenType.COMMA:
+        value_index += 2
+    if value_index >= len(tokens) or tokens[value_index].token_type != TokenType.NUMBER:
+        return None
+    return tokens[value_index]
+
+def enforce_row_limit(sql: str, db_type: str):
+    dialect = 'mysql' if db_type == 'mysql' else 'sqlite'
+    statements = [statement for statement in sqlglot.parse(sql, read=dialect) if statement is not None]
+    if len(statements) != 1:
+        raise ValueError(f"Expected a single SQL statement, got {len(statements)}")
+
+    statement = statements[0]
+    if not isinstance(statement, exp.Query):
+        raise ValueError("Only SELECT queries can be executed")
+
+    # Edit the query as written rather than regenerating it, since sqlglot's
+    # output can differ from the dialect the LLM targeted.
+    tokens = [token for token in sqlglot.tokenize(sql, read=dialect) if token.token_type != TokenType.SEMICOLON]
+    limit = statement.args.get("limit")
+    if limit is None:
+        return f"{sql[:tokens[-1].end + 1]} LIMIT {MAX_RESULT_ROWS}"
+
+    value = limit.expression
+    if not (isinstance(value, exp.Literal) and value.is_int):
+        return statement.limit(MAX_RESULT_ROWS).sql(dialect=dialect)
+    if int(value.this) <= MAX_RESULT_ROWS:
+        return sql
+
+    value_token = _top_level_limit_token(tokens)
+    if value_token is None:
+        return statement.limit(MAX_RESULT_ROWS).sql(dialect=dialect)
+    return f"{sql[:value_token.start]}{MAX_RESULT_ROWS}{sql[value_token.end + 1:]}"
+
+PROMPT_QUESTION_TEMPLATE = """
+    Previous Conversation History:
+    {history}
+    
+    Question: {input}
+    
+    Limit: {top_k}
+    """
+
+def classify_sql_error(exception: Exception):
+    if isinstance(exception, sqlglot.errors.ParseError):
+        return "syntax", None
+    error = str(exception)
+    if _PERMISSION_ERROR_RE.search(error):
+        return "permission", None
+    for pattern in _MISSING_OBJECT_RES:
+        match = pattern.search(error)
+        if match:
+            return "missing_object", match.group(1)
+    if _SYNTAX_ERROR_RE.search(error):
+        return "syntax", None
+    return "other", None
+
+def build_missing_object_hint(db_connection: DBConnection, db, identifier: str):
+    name = identifier.split(".")[-1].strip("`\"'")
+    schema = get_schema_info_service(db_connection)
+
+    similar_tables = set(difflib.get_close_matches(name, [table["name"] for table in schema["tables"]], n=3, cutoff=0.6))
+    similar_columns = []
+    for table in schema["tables"]:
+        matches = difflib.get_close_matches(name, [col["name"] for col in table["columns"]], n=3, cutoff=0.6)
+        if matches:
+            similar_tables.add(table["name"])
+            similar_columns.extend(f"{table['name']}.{match}" for match in matches)
+
+    if not similar_tables:
+        return f"`{name}` does not exist in the database and has no similarly named table or column.\n"
+
+    hint = f"`{name}` does not exist. Similar names: {', '.join(sorted(similar_tables) + similar_columns)}.\n"
+    table_info = db.get_table_info(table_names=sorted(similar_tables)[:5])
+    return hint + f"Relevant tables:\n{table_info}\n"
+
+def build_system_prompt(db_connection: DBConnection):
+    db_name = db_connection.config.get('database', 'data') if db_connection.type == 'mysql' else 'data'
+
+    if db_connection.type == 'mysql':
+        system_prompt = f"""You are a MySQL expert. Given an input question, create a syntactically correct MySQL query to run.
+        Unless the user specifies otherwise, obtain the relevant data from the database.
         
-        Limit: {{top_k}}
+        Important:
+        - If the user asks for "all table names", you MUST query the `information_schema.tables` table.
+        - Example: SELECT table_name FROM information_schema.tables WHERE table_schema = '{db_name}';
+        - Never query for all columns from a specific table, only ask for a few relevant columns given the question.
+        - Pay attention to use only the column names you can see in the tables below. Be careful to not query for columns that do not exist.
+        - Also, pay attention to which column is in which table.
+        - CRITICAL: Generate a SINGLE SQL query. Do NOT generate multiple queries separated by semicolons.
         """
+    else:
+        system_prompt = f"""You are a SQLite expert. Given an input question, create a syntactically correct SQLite query to run.
+        Unless the user specifies otherwise, obtain the relevant data from the database.
         
-        prompt = PromptTemplate.from_template(full_prompt_template)
-        chain = create_sql_query_chain(llm, db, k=100, prompt=prompt)
+        Important:
+        - If the user asks for "all table names", you MUST query the `sqlite_master` table.
+        - Example: SELECT name FROM sqlite_master WHERE type='table';
+        - Never query for all columns from a specific table, only ask for a few relevant columns given the question.
+        - Pay attention to use only the column names you can see in the tables below. Be careful to not query for columns that do not exist.
+        - Also, pay attention to which column is in which table.
+        - CRITICAL: Generate a SINGLE SQL query. Do NOT generate multiple queries separated by semicolons.
+        """
+
+    return system_prompt
+
+def build_prompt_template(db_connection: DBConnection):
+    # Static instructions and schema come first so the prompt prefix is
+    # byte-identical across turns for the same database; only the history
+    # and question at the tail change between requests.
+    return build_system_prompt(db_connection) + """
+    
+    Only use the following tables:
+    {table_info}
+    
+    """ + PROMPT_QUESTION_TEMPLATE
+
+def get_chain(db_connection: DBConnection, fingerprint: str = None):
+    key = fingerprint or connection_fingerprint(db_connection)
+    with _chain_cache_lock:
+        if key in _chain_cache:
+            _chain_cache.move_to_end(key)
+            return _chain_cache[key]
+
+    engine = get_engine(db_connection)
+    db = get_db(db_connection)
+    prompt = PromptTemplate.from_template(build_prompt_template(db_connection))
+    cheap_chain = create_sql_query_chain(cheap_llm, db, k=SQL_TOP_K, prompt=prompt)
+    strong_chain = create_sql_query_chain(strong_llm, db, k=SQL_TOP_K, prompt=prompt)
+
+    with _chain_cache_lock:
+        _chain_cache[key] = (cheap_chain, strong_chain, engine, db)
+        if len(_chain_cache) > CHAIN_CACHE_SIZE:
+            _chain_cache.popitem(last=False)
+
+    return cheap_chain, strong_chain, engine, db
+
+def get_prompt_cached_model(db_connection: DBConnection, db, fingerprint: str = None):
+    return prompt_cache.get_cached_model(
+        fingerprint or connection_fingerprint(db_connection),
+        CHEAP_MODEL,
+        build_system_prompt(db_connection),
+        db.get_table_info
+    )
+
+def warm_prompt_cache(db_connection: DBConnection):
+    try:
+        fingerprint = connection_fingerprint(db_connection)
+        _, _, _, db = get_chain(db_connection, fingerprint)
+        get_prompt_cached_model(db_connection, db, fingerprint)
+    except Exception as e:
+        print(f"Error warming prompt cache: {e}")
+
+def invalidate_query_caches(db_connection: DBConnection):
+    key = connection_fingerprint(db_connection)
+    with _chain_cache_lock:
+        entry = _chain_cache.pop(key, None)
+    if entry:
+        entry[3].clear_table_info_cache()
+    semantic_cache.invalidate(key)
+    prompt_cache.invalidate(key)
+    return invalidate_responses(key)
+
+def dataframe_records(df):
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            if getattr(series.dt, "tz", None) is not None:
+                df[column] = series.map(lambda value: value.isoformat() if not pd.isna(value) else None)
+            elif (series.dt.microsecond.fillna(0) != 0).any():
+                df[column] = series.dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+            else:
+                df[column] = series.dt.strftime("%Y-%m-%dT%H:%M:%S")
+        elif pd.api.types.is_timedelta64_dtype(series):
+            df[column] = series.dt.total_seconds()
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+def execute_sql(engine, sql: str):
+    with engine.connect() as connection:
+        # Nullable dtypes keep integer columns with NULLs as integers,
+        # matching the rows the streaming path returns.
+        df = pd.read_sql_query(text(sql), connection, dtype_backend="numpy_nullable")
+    return dataframe_records(df)
+
+def ndjson_response(question: str, sql: str, row_chunks, on_close=None):
+    def generate():
+        try:
+            yield orjson.dumps({"question": question, "sql": sql}) + b"\n"
+            for chunk in row_chunks:
+                yield b"".join(orjson.dumps(row, default=serialize_value) + b"\n" for row in chunk)
+        finally:
+            if on_close:
+                on_close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+def stream_sql_response(engine, question: str, sql: str):
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result_proxy = connection.execute(text(sql))
+    except Exception:
+        connection.close()
+        raise
+
+    def row_chunks():
+        if not result_proxy.returns_rows:
+            return
+        keys = list(result_proxy.keys())
+        while chunk := result_proxy.fetchmany(STREAM_CHUNK_SIZE):
+            yield [dict(zip(keys, row)) for row in chunk]
+
+    return ndjson_response(question, sql, row_chunks(), on_close=connection.close)
+
+async def generate_sql_response(request: QueryRequest, use_cache: bool = True, stream: bool = False):
+    try:
+        # Hashing a large csvContent is not free; do it once, off the event loop.
+        db_fingerprint = await asyncio.to_thread(connection_fingerprint, request.db_connection)
+        history_buffer = HistoryBuffer()
+        cache_key = response_cache_key(
+            db_fingerprint,
+            request.question,
+            history_buffer.lines(request.history)
+        )
+        if use_cache:
+            cached_response = get_cached_response(cache_key)
+            if cached_response is not None:
+                if stream:
+                    return ndjson_response(request.question, cached_response["sql"], [cached_response["data"]])
+                return json_response({**cached_response, "question": request.question})
+
+        fast_path_sql = await asyncio.to_thread(match_fast_path, request.question, request.db_connection)
+        if fast_path_sql:
+            engine = await asyncio.to_thread(get_engine, request.db_connection)
+            if stream:
+                return await asyncio.to_thread(stream_sql_response, engine, request.question, fast_path_sql)
+            response_payload = {
+                "question": request.question,
+                "sql": fast_path_sql,
+                "data": await asyncio.to_thread(execute_sql, engine, fast_path_sql)
+            }
+            set_cached_response(cache_key, response_payload)
+            return json_response(response_payload)
+
+        cheap_chain, strong_chain, engine, db = await asyncio.to_thread(get_chain, request.db_connection, db_fingerprint)
+        chat_history_str = history_buffer.render(request.history)
+
+        semantic_match = None
+        if not request.history:
+            semantic_match = await asyncio.to_thread(semantic_cache.lookup, db_fingerprint, request.question)
+            reused_sql = semantic_cache.adapt_cached_sql(semantic_match) if use_cache else None
+            if reused_sql:
+                try:
+                    reused_sql = enforce_row_limit(reused_sql, request.db_connection.type)
+                    if stream:
+                        return await asyncio.to_thread(stream_sql_response, engine, request.question, reused_sql)
+                    response_payload = {
+                        "question": request.question,
+                        "sql": reused_sql,
+                        "data": await asyncio.to_thread(execute_sql, engine, reused_sql)
+                    }
+                    set_cached_response(cache_key, response_payload)
+                    return json_response(response_payload)
+                except Exception as e:
+                    print(f"Error executing semantically cached SQL: {e}")
+
+        base_question = request.question
+        exemplar = semantic_cache.exemplar_sql(semantic_match)
+        if exemplar:
+            base_question = f"{request.question}\n\nA similar question was previously answered with this SQL, adapt it if it fits:\n{exemplar}"
         
         max_retries = 3
         last_error = None
-        current_question = request.question
+        last_error_kind = None
+        error_hint = ""
+        syntax_failures = 0
+        attempts = 0
+        current_question = base_question
+        escalate = is_complex_question(request.question)
+        cached_model = None if escalate else await asyncio.to_thread(get_prompt_cached_model, request.db_connection, db, db_fingerprint)
         
         for attempt in range(max_retries):
             try:
+                attempts = attempt + 1
                 if attempt > 0:
                     print(f"Self-correction attempt {attempt}: Retrying with error context...")
-                    current_question = f"{request.question}\n\nThe previous query failed with error: {last_error}\nPlease fix the SQL."
+                    current_question = f"{base_question}\n\nThe previous query failed with error: {last_error}\n{error_hint}Please fix the SQL."
 
-                response = chain.invoke({"question": current_question})
-                cleaned_sql = response
-                
-                code_block_pattern = r"```(?:sqlite|mysql|sql)?\s*(.*?)```"
-                match = re.search(code_block_pattern, cleaned_sql, re.DOTALL | re.IGNORECASE)
-                if match:
-                    cleaned_sql = match.group(1)
-
-                if "SQLQuery:" in cleaned_sql:
-                    cleaned_sql = cleaned_sql.split("SQLQuery:")[1]
-                    
-                cleaned_sql = cleaned_sql.strip()
+                if attempt == 0 and cached_model is not None:
+                    prompt = PROMPT_QUESTION_TEMPLATE.format(
+                        history=chat_history_str,
+                        input=current_question + "\nSQLQuery: ",
+                        top_k=SQL_TOP_K
+                    )
+                    response = await asyncio.to_thread(prompt_cache.generate_with_cached_model, cached_model, prompt)
+                else:
+                    use_strong = escalate or (attempt > 0 and last_error_kind != "syntax")
+                    chain = strong_chain if use_strong else cheap_chain
+                    response = await asyncio.to_thread(chain.invoke, {"question": current_question, "history": chat_history_str})
+                cleaned_sql = enforce_row_limit(clean_sql(response), request.db_connection.type)
+
+                if stream:
+                    streamed_response = await asyncio.to_thread(stream_sql_response, engine, request.question, cleaned_sql)
+                    if not request.history:
+                        semantic_cache.store(db_fingerprint, semantic_match, cleaned_sql)
+                    return streamed_response
                 
-                result_data = []
-                with engine.connect() as connection:
-                    result_proxy = connection.execute(text(cleaned_sql))
-                    if result_proxy.returns_rows:
-                        keys = result_proxy.keys()
-                        result_data = [
-                            {key: serialize_value(value) for key, value in zip(keys, row)}
-                            for row in result_proxy.fetchall()
-                        ]
+                result_data = await asyncio.to_thread(execute_sql, engine, cleaned_sql)
                 
-                return {
+                response_payload = {
                     "question": request.question,
                     "sql": cleaned_sql,
                     "data": result_data
                 }
+                set_cached_response(cache_key, response_payload)
+                if not request.history:
+                    semantic_cache.store(db_fingerprint, semantic_match, cleaned_sql)
+                return json_response(response_payload)
 
             except Exception as e:
                 print(f"Error executing SQL (Attempt {attempt+1}/{max_retries}): {e}")
                 last_error = str(e)
+                last_error_kind, identifier = classify_sql_error(e)
+                error_hint = ""
+
+                if last_error_kind == "permission":
+                    break
+                if last_error_kind == "syntax":
+                    syntax_failures += 1
+                    if syntax_failures >= SYNTAX_ERROR_MAX_ATTEMPTS:
+                        break
+                if last_error_kind == "missing_object" and attempt + 1 < max_retries:
+                    try:
+                        error_hint = await asyncio.to_thread(build_missing_object_hint, request.db_connection, db, identifier)
+                    except Exception as hint_error:
+                        print(f"Error building schema hint: {hint_error}")
         
-        raise HTTPException(status_code=500, detail=f"Failed to generate valid SQL after {max_retries} attempts. Last error: {last_error}")
+        raise HTTPException(status_code=500, detail=f"Failed to generate valid SQL after {attempts} attempts. Last error: {last_error}")
 
     except Exception as e:
         print(f"Error processing query: {e}")
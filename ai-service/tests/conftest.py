@@ -0,0 +1,3 @@
+import os
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
@@ -0,0 +1,64 @@
+from app.services.semantic_cache import skeletonize, substitute_entities, adapt_cached_sql, exemplar_sql
+
+def test_skeletonize_replaces_literals_with_placeholders():
+    skeleton, entities = skeletonize("Show customers in 'Paris' aged between 10 and 20")
+    assert skeleton == "show customers in <str> aged between <num> and <num>"
+    assert entities == ["Paris", "10", "20"]
+
+def test_skeletonize_captures_capitalised_entities():
+    skeleton, entities = skeletonize("How many orders came from New York?")
+    assert skeleton == "how many orders came from <ent>?"
+    assert entities == ["New York"]
+
+def test_skeletonize_matches_across_values():
+    assert skeletonize("customers aged between 10 and 20")[0] == skeletonize("customers aged between 20 and 30")[0]
+
+def test_substitute_entities_does_not_chain_replacements():
+    sql = "SELECT name FROM customers WHERE age BETWEEN 10 AND 20"
+    assert substitute_entities(sql, ["10", "20"], ["20", "30"]) == "SELECT name FROM customers WHERE age BETWEEN 20 AND 30"
+
+def test_substitute_entities_swaps_values():
+    sql = "SELECT * FROM t WHERE a = 1 AND b = 2"
+    assert substitute_entities(sql, ["1", "2"], ["2", "1"]) == "SELECT * FROM t WHERE a = 2 AND b = 1"
+
+def test_substitute_entities_rejects_repeated_literal():
+    sql = "SELECT * FROM orders WHERE n > 10 LIMIT 10"
+    assert substitute_entities(sql, ["10"], ["5"]) is None
+
+def test_substitute_entities_rejects_missing_literal():
+    sql = "SELECT * FROM orders WHERE city = 'Paris'"
+    assert substitute_entities(sql, ["London"], ["Berlin"]) is None
+
+def test_substitute_entities_rejects_mismatched_entities():
+    assert substitute_entities("SELECT 1", ["1"], []) is None
+    assert substitute_entities("SELECT 1", ["1", "1"], ["2", "3"]) is None
+
+def test_substitute_entities_prefers_longest_literal():
+    sql = "SELECT * FROM stores WHERE status = 'New' AND city = 'New York'"
+    assert substitute_entities(sql, ["New", "New York"], ["Open", "Boston"]) == "SELECT * FROM stores WHERE status = 'Open' AND city = 'Boston'"
+
+def test_substitute_entities_ignores_partial_numbers():
+    sql = "SELECT * FROM items WHERE price > 10.5"
+    assert substitute_entities(sql, ["10"], ["20"]) is None
+
+def test_substitute_entities_keeps_unchanged_literals():
+    sql = "SELECT * FROM orders WHERE n > 10 LIMIT 10"
+    assert substitute_entities(sql, ["10"], ["10"]) == sql
+
+def _cache_match(cached_question, sql, question, similarity=1.0):
+    cached_skeleton, cached_entities = skeletonize(cached_question)
+    skeleton, entities = skeletonize(question)
+    entry = {"skeleton": cached_skeleton, "entities": cached_entities, "sql": sql}
+    return {"skeleton": skeleton, "entities": entities, "similarity": similarity, "entry": entry}
+
+def test_adapt_cached_sql_substitutes_when_only_literals_differ():
+    match = _cache_match("customers older than 30", "SELECT name FROM customers WHERE age > 30", "customers older than 40")
+    assert adapt_cached_sql(match) == "SELECT name FROM customers WHERE age > 40"
+
+def test_adapt_cached_sql_rejects_different_skeletons():
+    match = _cache_match("show customers in paris", "SELECT * FROM customers WHERE city='paris'", "show customers in london")
+    assert adapt_cached_sql(match) is None
+    assert exemplar_sql(match) == "SELECT * FROM customers WHERE city='paris'"
+
+    match = _cache_match("top customers by revenue", "SELECT name FROM customers ORDER BY revenue DESC", "top customers by order count")
+    assert adapt_cached_sql(match) is None
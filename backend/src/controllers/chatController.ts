@@ -52,11 +52,11 @@ export const sendMessage = async (req: AuthRequest, res: Response) => {
        }
     }
 
-    let history: string[] = [];
+    let history: { role: string; content: string }[] = [];
     if (session && session.messages) {
        const lastMessages = session.messages.slice(-10);
        history = lastMessages.map((msg: any) => {
-          return `${msg.role === 'user' ? 'User' : 'AI'}: ${msg.content}`; 
+          return { role: msg.role === 'user' ? 'user' : 'ai', content: msg.content };
        });
     }
 